@@ -1,5 +1,9 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import msgspec
+from typing import Optional
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
@@ -10,7 +14,15 @@ import google.generativeai as genai
 import logging
 import traceback
 import time
-from google.api_core import exceptions, retry
+import asyncio
+import threading
+import hashlib
+import re
+from collections import OrderedDict
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core import exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from dotenv import load_dotenv
 from email.mime.text import MIMEText
 from html.parser import HTMLParser
@@ -43,10 +55,79 @@ def log_action(message):
     logging.info(message)
     print(message)
 
+# ServiceNow HTTP session (keep-alive connection pool shared by all ticket calls)
+AUTH_HEADER = "Basic " + base64.b64encode(f"{SNOW_USER}:{SNOW_PASS}".encode('utf-8')).decode('ascii')
+SNOW = requests.Session()
+SNOW.headers.update({
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+    "Authorization": AUTH_HEADER
+})
+SNOW.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    # PATCH field updates are idempotent and safe to retry; POST is not, so a retried
+    # create can never file a duplicate ticket
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"},
+        raise_on_status=False
+    )
+))
+SNOW_TIMEOUT = 10
+
+# Async pipeline limits (emails handling ServiceNow/Gmail actions at once)
+EMAIL_CONCURRENCY = 8
+# The Gmail client (httplib2) is not thread-safe, so every Gmail call runs on one dedicated thread
+GMAIL_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gmail")
+
+# Gmail recommends at most 50 requests per batch
+GMAIL_BATCH_SIZE = 50
+
+async def run_on_gmail_thread(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(GMAIL_EXECUTOR, func, *args)
+
+async def execute_gmail(request):
+    return await run_on_gmail_thread(request.execute)
+
 # Gmail API setup
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify', 'https://www.googleapis.com/auth/gmail.send']
 
+# Refresh Gmail credentials this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+_gmail_service = None
+
+def refresh_credentials(creds, token_path):
+    try:
+        log_action("Refreshing Gmail credentials ahead of expiry...")
+        creds.refresh(Request())
+        with open(token_path, 'wb') as token:
+            pickle.dump(creds, token)
+    except Exception as e:
+        log_action(f"Error refreshing Gmail credentials: {e}")
+        traceback.print_exc()
+        return
+    schedule_token_refresh(creds, token_path)
+
+def schedule_token_refresh(creds, token_path):
+    if not creds.expiry or not creds.refresh_token:
+        return
+    # creds.expiry is a naive UTC datetime
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    delay = max((creds.expiry - now).total_seconds() - TOKEN_REFRESH_MARGIN, 0)
+    # Run the refresh on the Gmail thread so it never races an in-flight Gmail request
+    timer = threading.Timer(delay, GMAIL_EXECUTOR.submit, args=(refresh_credentials, creds, token_path))
+    timer.daemon = True
+    timer.start()
+
 def get_gmail_service():
+    global _gmail_service
+    if _gmail_service is not None:
+        return _gmail_service
+
     creds = None
     token_path = os.path.join(BASE_DIR, 'token.pickle')
     creds_path = os.path.join(BASE_DIR, 'credentials.json')
@@ -70,6 +151,8 @@ def get_gmail_service():
             with open(token_path, 'wb') as token:
                 pickle.dump(creds, token)
         service = build('gmail', 'v1', credentials=creds)
+        schedule_token_refresh(creds, token_path)
+        _gmail_service = service
         log_action("Gmail service initialized successfully.")
         return service
     except Exception as e:
@@ -88,51 +171,159 @@ except Exception as e:
     traceback.print_exc()
     model = None
 
-# Retry decorator for Gemini API
-@retry.Retry(predicate=retry.if_exception_type(exceptions.ResourceExhausted), initial=46, maximum=120, multiplier=2)
-def call_gemini_with_retry(prompt):
-    return model.generate_content(prompt)
+# Token bucket sized to the gemini-1.5-flash free tier (15 requests per minute)
+GEMINI_RPM = 15
 
-def analyze_email(email_content):
-    if not model:
-        log_action("Gemini model not initialized, skipping email analysis")
-        return {'action': 'ignore', 'priority': 'normal', 'table': 'incident', 'status': 'New'}
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        # Runs on the event loop thread only; a negative balance reserves a future slot
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+gemini_bucket = TokenBucket(rate=GEMINI_RPM / 60, burst=GEMINI_RPM)
+
+# Retry decorator for Gemini API: jittered backoff, capped at 4 attempts or 60 seconds of
+# backoff sleep. idle_for only counts the backoff, so time spent waiting on gemini_bucket
+# does not eat into the retry budget.
+@retry(
+    retry=retry_if_exception_type(exceptions.ResourceExhausted),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(4) | (lambda retry_state: retry_state.idle_for >= 60),
+    reraise=True
+)
+async def call_gemini_with_retry(prompt):
+    await gemini_bucket.acquire()
+    return await model.generate_content_async(prompt)
+
+# Parsed classification of an email, decoded straight from Gemini's JSON.
+# Defaulted fields accept null so a partially filled reply is still usable.
+class Analysis(msgspec.Struct, frozen=True):
+    action: str
+    priority: Optional[str] = 'normal'
+    table: Optional[str] = 'incident'
+    status: Optional[str] = 'New'
+    ticket_number: Optional[str] = None
+    comment: Optional[str] = None
+
+IGNORE_ANALYSIS = Analysis(action='ignore')
+
+# In-process LRU cache of Gemini classifications, keyed on the normalized email body.
+# Bump PROMPT_VERSION whenever the prompt changes so stale results are not reused.
+PROMPT_VERSION = "v3"
+ANALYSIS_CACHE_SIZE = 1024
+_analysis_cache = OrderedDict()
+# Gemini calls currently running, by cache key
+_inflight_analyses = {}
+
+def analysis_cache_key(email_content):
+    digest = hashlib.sha256(email_content.strip().lower().encode('utf-8')).hexdigest()
+    return f"{PROMPT_VERSION}:{digest}"
+
+def get_cached_analysis(key):
+    result = _analysis_cache.get(key)
+    if result is not None:
+        _analysis_cache.move_to_end(key)
+    return result
+
+def cache_analysis(key, result):
+    _analysis_cache[key] = result
+    _analysis_cache.move_to_end(key)
+    if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+        _analysis_cache.popitem(last=False)
+
+# ServiceNow state codes by display name
+STATE_MAP = {
+    "New": "1", "In Progress": "2", "On Hold": "3",
+    "Resolved": "6", "Closed": "7", "Cancelled": "8"
+}
+
+# Update commands, e.g. "Set ticket INC0010111 to Resolved with comment: Fixed"
+SET_TICKET_RE = re.compile(r"set ticket (\w{3}\d{7}) to (\w+)", re.IGNORECASE)
+COMMENT_RE = re.compile(r"with comment: (.+)", re.IGNORECASE)
 
+# Cheap classification rules checked before falling back to Gemini (first match wins).
+# Rules only look at the first line so quoted replies and passing mentions ("not urgent")
+# are left to Gemini; anything ambiguous falls through.
+RULE_SCAN_CHARS = 200
+RULES = [
+    (re.compile(r"out of office|auto-?reply", re.IGNORECASE), IGNORE_ANALYSIS),
+    (re.compile(r"^\s*(approved?|lgtm)\b", re.IGNORECASE),
+     Analysis(action='approve', table='change_request')),
+    (re.compile(r"^\s*denied?\b", re.IGNORECASE),
+     Analysis(action='deny', table='change_request')),
+    (re.compile(r"^\s*(urgent|P1|outage)\b", re.IGNORECASE),
+     Analysis(action='create_incident', priority='high')),
+]
+
+async def analyze_email(email_content):
     if not email_content or email_content.strip() == "":
         log_action("Empty email content, returning ignore action")
-        return {'action': 'ignore', 'priority': 'normal', 'table': 'incident', 'status': 'New'}
+        return IGNORE_ANALYSIS
 
     # Bypass Gemini for explicit change requests
     if email_content.lower().startswith("change:"):
         log_action("Detected 'Change:' in email, assigning create_change action")
-        return {'action': 'create_change', 'priority': 'normal', 'table': 'change_request', 'status': 'New'}
+        return Analysis(action='create_change', table='change_request')
 
     # Detect update commands (e.g., "Set ticket INC0010111 to Resolved")
     if "set ticket" in email_content.lower():
-        import re
-        match = re.search(r"set ticket (\w{3}\d{7}) to (\w+)", email_content.lower())
+        match = SET_TICKET_RE.search(email_content)
         if match:
             ticket_number = match.group(1).upper()
             status = match.group(2).capitalize()
-            comment_match = re.search(r"with comment: (.+)", email_content, re.IGNORECASE)
+            comment_match = COMMENT_RE.search(email_content)
             comment = comment_match.group(1) if comment_match else "Updated via email"
-            state_map = {
-                "New": "1", "In Progress": "2", "On Hold": "3",
-                "Resolved": "6", "Closed": "7", "Cancelled": "8"
-            }
-            if status in state_map:
+            if status in STATE_MAP:
                 log_action(f"Detected update for ticket {ticket_number} to {status}")
-                return {
-                    'action': 'update_ticket',
-                    'ticket_number': ticket_number,
-                    'table': 'incident' if ticket_number.startswith('INC') else 'change_request',
-                    'status': status,
-                    'comment': comment
-                }
+                return Analysis(
+                    action='update_ticket',
+                    ticket_number=ticket_number,
+                    table='incident' if ticket_number.startswith('INC') else 'change_request',
+                    status=status,
+                    comment=comment
+                )
             else:
                 log_action(f"Invalid status {status} for ticket {ticket_number}")
-                return {'action': 'ignore', 'priority': 'normal', 'table': 'incident', 'status': 'New'}
+                return IGNORE_ANALYSIS
+
+    first_line = email_content.strip().split('\n', 1)[0][:RULE_SCAN_CHARS]
+    for pattern, result in RULES:
+        if pattern.search(first_line):
+            log_action(f"Matched rule '{pattern.pattern}', assigning {result.action} action")
+            return result
+
+    if not model:
+        log_action("Gemini model not initialized, skipping email analysis")
+        return IGNORE_ANALYSIS
+
+    cache_key = analysis_cache_key(email_content)
+    cached = get_cached_analysis(cache_key)
+    if cached is not None:
+        log_action(f"Using cached email analysis result: {cached}")
+        return cached
+
+    # Identical bodies arriving in the same run share one Gemini call
+    task = _inflight_analyses.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(classify_with_gemini(email_content, cache_key))
+        _inflight_analyses[cache_key] = task
+        task.add_done_callback(lambda _: _inflight_analyses.pop(cache_key, None))
+    else:
+        log_action("Identical email is already being analyzed, sharing its result")
+    # Shield so cancelling one waiter does not cancel the call other emails are awaiting
+    return await asyncio.shield(task)
 
+async def classify_with_gemini(email_content, cache_key):
     prompt = f"""
     Analyze this email content: "{email_content}"
     Return a JSON object with:
@@ -147,32 +338,38 @@ def analyze_email(email_content):
     """
     try:
         log_action("Analyzing email content with Gemini...")
-        response = call_gemini_with_retry(prompt)
+        response = await call_gemini_with_retry(prompt)
         text = response.text.strip()
         if text.startswith('```json'):
             text = text[7:].rstrip('```').strip()
         elif text.startswith('```'):
             text = text[3:].rstrip('```').strip()
-        result = json.loads(text)
+        result = msgspec.json.decode(text, type=Analysis)
+        result = msgspec.structs.replace(
+            result,
+            priority=result.priority or 'normal',
+            table=result.table or 'incident',
+            status=result.status or 'New'
+        )
         log_action(f"Email analysis result: {result}")
+        cache_analysis(cache_key, result)
         return result
-    except json.JSONDecodeError as e:
+    except msgspec.ValidationError as e:
+        log_action(f"Gemini response does not match the expected schema: {e}. Response: {text}")
+        return IGNORE_ANALYSIS
+    except msgspec.DecodeError as e:
         log_action(f"JSON parsing error: {e}. Response: {text}")
-        return {'action': 'ignore', 'priority': 'normal', 'table': 'incident', 'status': 'New'}
+        return IGNORE_ANALYSIS
     except exceptions.ResourceExhausted as e:
         log_action(f"Gemini quota exceeded: {e}")
-        return {'action': 'ignore', 'priority': 'normal', 'table': 'incident', 'status': 'New'}
+        return IGNORE_ANALYSIS
     except Exception as e:
         log_action(f"Error analyzing email: {e}")
         traceback.print_exc()
-        return {'action': 'ignore', 'priority': 'normal', 'table': 'incident', 'status': 'New'}
+        return IGNORE_ANALYSIS
 
-def create_ticket(table, subject, description, priority):
+async def create_ticket(table, subject, description, priority):
     try:
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json"
-        }
         data = {
             "short_description": subject,
             "description": description,
@@ -185,9 +382,9 @@ def create_ticket(table, subject, description, priority):
             data["approval"] = "requested"
         url = f"{SNOW_URL}/{table}"
         log_action(f"Creating {table} ticket: {subject}")
-        response = requests.post(url, auth=(SNOW_USER, SNOW_PASS), headers=headers, json=data)
+        response = await asyncio.to_thread(SNOW.post, url, data=orjson.dumps(data), timeout=SNOW_TIMEOUT)
         if response.status_code == 201:
-            result = response.json()['result']
+            result = orjson.loads(response.content)['result']
             log_action(f"Ticket Created: {result['number']} (ID: {result['sys_id']})")
             return result['sys_id'], result['number']
         else:
@@ -198,15 +395,10 @@ def create_ticket(table, subject, description, priority):
         traceback.print_exc()
         return None, None
 
-def update_ticket(table, ticket_number, status, comment, priority='normal'):
+async def update_ticket(table, ticket_number, status, comment, priority='normal'):
     try:
-        headers = {"Content-Type": "application/json", "Accept": "application/json"}
-        state_map = {
-            "New": "1", "In Progress": "2", "On Hold": "3",
-            "Resolved": "6", "Closed": "7", "Cancelled": "8"
-        }
         data = {
-            "state": state_map.get(status, "1"),
+            "state": STATE_MAP.get(status, "1"),
             "comments": comment,
             "priority": "1" if priority == "high" else "4"
         }
@@ -214,7 +406,7 @@ def update_ticket(table, ticket_number, status, comment, priority='normal'):
             data["approval"] = "approved"
         url = f"{SNOW_URL}/{table}/{ticket_number}"
         log_action(f"Updating {table} ticket {ticket_number} to {status}")
-        response = requests.patch(url, auth=(SNOW_USER, SNOW_PASS), headers=headers, json=data)
+        response = await asyncio.to_thread(SNOW.patch, url, data=orjson.dumps(data), timeout=SNOW_TIMEOUT)
         if response.status_code == 200:
             log_action(f"Updated {table} ticket {ticket_number} to {status}")
         else:
@@ -223,7 +415,7 @@ def update_ticket(table, ticket_number, status, comment, priority='normal'):
         log_action(f"Error updating ticket: {e}")
         traceback.print_exc()
 
-def send_approval_email(service, ticket_number, subject, description):
+async def send_approval_email(service, ticket_number, subject, description):
     try:
         log_action(f"Preparing approval email for ticket {ticket_number} to {MANAGER_EMAIL}")
         message = MIMEText(
@@ -237,23 +429,119 @@ def send_approval_email(service, ticket_number, subject, description):
         message['Subject'] = f"Approval Needed for Ticket {ticket_number}"
         raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
         log_action(f"Sending approval email for ticket {ticket_number}")
-        service.users().messages().send(
+        await execute_gmail(service.users().messages().send(
             userId='me',
             body={'raw': raw_message}
-        ).execute()
+        ))
         log_action(f"Sent approval email for ticket {ticket_number} to {MANAGER_EMAIL}")
     except Exception as e:
         log_action(f"Error sending approval email: {e}")
         traceback.print_exc()
 
-def process_emails():
-    service = get_gmail_service()
+class HTMLStripper(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.text = []
+    def handle_data(self, data):
+        self.text.append(data.strip())
+    def get_text(self):
+        return ' '.join(self.text).strip()
+
+def extract_body(msg_detail):
+    parts = msg_detail['payload'].get('parts', [])
+    if not parts:
+        return msg_detail.get('snippet', '')
+
+    parts_by_mime = {}
+    for part in parts:
+        parts_by_mime.setdefault(part['mimeType'], part)
+
+    # Prefer text/plain; only parse HTML when no plain-text body is available
+    plain = parts_by_mime.get('text/plain')
+    data = plain['body'].get('data') if plain else None
+    if data:
+        return base64.urlsafe_b64decode(data).decode('utf-8')
+
+    html = parts_by_mime.get('text/html')
+    data = html['body'].get('data') if html else None
+    if data:
+        stripper = HTMLStripper()
+        stripper.feed(base64.urlsafe_b64decode(data).decode('utf-8'))
+        return stripper.get_text()
+    return ''
+
+def fetch_messages(service, msg_ids):
+    details = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            log_action(f"Error fetching email {request_id}: {exception}")
+        else:
+            details[request_id] = response
+
+    for start in range(0, len(msg_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for msg_id in msg_ids[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(service.users().messages().get(userId='me', id=msg_id, format='full'), request_id=msg_id)
+        batch.execute()
+    return details
+
+async def process_email(service, msg_id, msg_detail, existing_tickets, ticket_log, semaphore):
+    log_action(f"Processing email ID: {msg_id}")
+    headers = {h['name']: h['value'] for h in msg_detail['payload']['headers']}
+    subject = headers.get('Subject', '')
+    from_email = headers.get('From', '')
+    log_action(f"Fetched email subject: {subject}")
+
+    body = extract_body(msg_detail)
+    log_action(f"Email subject: {subject}, body: {body[:50]}...")
+
+    # Classify outside the semaphore: Gemini calls are paced by gemini_bucket, and waiting
+    # for a token must not hold a slot needed by emails that never reach Gemini
+    analysis = await analyze_email(body)
+    async with semaphore:
+        await handle_analysis(service, analysis, subject, body, existing_tickets, ticket_log)
+
+async def handle_analysis(service, analysis, subject, body, existing_tickets, ticket_log):
+    action = analysis.action
+    priority = analysis.priority
+    table = analysis.table
+    status = analysis.status
+
+    if action == "ignore":
+        log_action(f"Ignored email: {subject}")
+    elif action == "create_incident" or action == "create_change":
+        ticket_id, ticket_number = await create_ticket(table, subject, body, priority)
+        if ticket_id:
+            # Check if ticket number already exists
+            if ticket_number in existing_tickets:
+                log_action(f"Skipping duplicate ticket number: {ticket_number}")
+                return
+            # Write "Subject - TicketNumber" to ticket_ids.txt
+            ticket_log.write(f"{subject} - {ticket_number}\n")
+            # Send approval email for change requests or high-priority incidents
+            if table == "change_request" or (table == "incident" and priority == "high"):
+                await send_approval_email(service, ticket_number, subject, body)
+    elif action == "update_ticket":
+        ticket_number = analysis.ticket_number
+        comment = analysis.comment
+        await update_ticket(table, ticket_number, status, comment, priority)
+    elif action in ["set_new", "set_in_progress", "set_on_hold", "set_resolved", "set_closed", "set_cancelled"]:
+        log_action(f"Update action {action} requested but ticket ID extraction not implemented for email: {subject}")
+    elif action in ["approve", "deny"]:
+        log_action(f"Approval action '{action}' received for email: {subject}")
+    else:
+        log_action(f"Unknown action '{action}' for email: {subject}")
+
+async def process_emails():
+    # Token load/refresh and the OAuth flow block, so build the service on the Gmail thread
+    service = await run_on_gmail_thread(get_gmail_service)
     if not service:
         log_action("Failed to initialize Gmail service, exiting.")
         return
     try:
         log_action("Fetching emails...")
-        results = service.users().messages().list(userId='me', q=f"to:{GMAIL_ADDRESS} is:unread").execute()
+        results = await execute_gmail(service.users().messages().list(userId='me', q=f"to:{GMAIL_ADDRESS} is:unread"))
         messages = results.get('messages', [])
         if not messages:
             log_action("No unread emails found to process.")
@@ -273,85 +561,33 @@ def process_emails():
                             ticket_number = line.split(' - ')[-1]
                             existing_tickets.add(ticket_number)
 
-        for i, msg in enumerate(messages):
-            msg_id = msg['id']
-            log_action(f"Processing email ID: {msg_id}")
-            msg_detail = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-            headers = msg_detail['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '')
-            from_email = next((h['value'] for h in headers if h['name'] == 'From'), '')
-            snippet = msg_detail.get('snippet', '')
-            log_action(f"Fetched email subject: {subject}")
-
-            body = ''
-            parts = msg_detail['payload'].get('parts', [])
-            if parts:
-                for part in parts:
-                    if part['mimeType'] == 'text/plain':
-                        data = part['body'].get('data')
-                        if data:
-                            body = base64.urlsafe_b64decode(data).decode('utf-8')
-                            break
-                    elif part['mimeType'] == 'text/html':
-                        data = part['body'].get('data')
-                        if data:
-                            class HTMLStripper(HTMLParser):
-                                def __init__(self):
-                                    super().__init__()
-                                    self.text = []
-                                def handle_data(self, data):
-                                    self.text.append(data.strip())
-                                def get_text(self):
-                                    return ' '.join(self.text).strip()
-                            stripper = HTMLStripper()
-                            stripper.feed(base64.urlsafe_b64decode(data).decode('utf-8'))
-                            body = stripper.get_text()
-                            if body:
-                                break
-            else:
-                body = snippet
-            log_action(f"Email subject: {subject}, body: {body[:50]}...")
-
-            analysis = analyze_email(body)
-            action = analysis.get('action')
-            priority = analysis.get('priority')
-            table = analysis.get('table')
-            status = analysis.get('status')
-
-            if action == "ignore":
-                log_action(f"Ignored email: {subject}")
-            elif action == "create_incident" or action == "create_change":
-                ticket_id, ticket_number = create_ticket(table, subject, body, priority)
-                if ticket_id:
-                    # Check if ticket number already exists
-                    if ticket_number in existing_tickets:
-                        log_action(f"Skipping duplicate ticket number: {ticket_number}")
-                        service.users().messages().modify(userId='me', id=msg_id, body={'removeLabelIds': ['UNREAD']}).execute()
-                        continue
-                    # Write "Subject - TicketNumber" to ticket_ids.txt
-                    with open(ticket_ids_file, 'a') as f:
-                        f.write(f"{subject} - {ticket_number}\n")
-                    # Send approval email for change requests or high-priority incidents
-                    if table == "change_request" or (table == "incident" and priority == "high"):
-                        send_approval_email(service, ticket_number, subject, body)
-            elif action == "update_ticket":
-                ticket_number = analysis.get('ticket_number')
-                status = analysis.get('status')
-                comment = analysis.get('comment')
-                update_ticket(table, ticket_number, status, comment, priority)
-            elif action in ["set_new", "set_in_progress", "set_on_hold", 'set_resolved', "set_closed", "set_cancelled"]:
-                log_action(f"Update action {action} requested but ticket ID extraction not implemented for email: {subject}")
-            elif action in ["approve", "deny"]:
-                log_action(f"Approval action '{action}' received for email: {subject}")
-            else:
-                log_action(f"Unknown action '{action}' for email: {subject}")
+        msg_ids = [msg['id'] for msg in messages]
+        details = await run_on_gmail_thread(fetch_messages, service, msg_ids)
+
+        semaphore = asyncio.Semaphore(EMAIL_CONCURRENCY)
+        processed_ids = []
+        # Opened once for the whole run; line buffering flushes each ticket as it is recorded
+        ticket_log = open(ticket_ids_file, 'a', buffering=1)
 
-            log_action(f"Marking email {msg_id} as read.")
-            service.users().messages().modify(userId='me', id=msg_id, body={'removeLabelIds': ['UNREAD']}).execute()
+        async def process_bounded(msg_id):
+            try:
+                await process_email(service, msg_id, details[msg_id], existing_tickets, ticket_log, semaphore)
+                processed_ids.append(msg_id)
+            except Exception as e:
+                log_action(f"Error processing email {msg_id}: {e}")
+                traceback.print_exc()
 
-            if i < len(messages) - 1:
-                log_action("Waiting 5 seconds to avoid Gemini rate limit...")
-                time.sleep(5)
+        try:
+            await asyncio.gather(*(process_bounded(msg_id) for msg_id in msg_ids if msg_id in details))
+        finally:
+            ticket_log.close()
+            # Mark handled emails read even if the run is cancelled or interrupted part-way
+            if processed_ids:
+                log_action(f"Marking {len(processed_ids)} emails as read.")
+                await execute_gmail(service.users().messages().batchModify(
+                    userId='me',
+                    body={'ids': processed_ids, 'removeLabelIds': ['UNREAD']}
+                ))
 
     except Exception as e:
         log_action(f"Error processing emails: {e}")
@@ -359,4 +595,4 @@ def process_emails():
 
 if __name__ == "__main__":
     log_action("Starting ServiceNowAgent...")
-    process_emails()
\ No newline at end of file
+    asyncio.run(process_emails())